@@ -1,27 +1,79 @@
 """
 Helm common functions module, based on Local shell
 """
+import base64
+import concurrent.futures
+import collections
 import enum
+import fnmatch
 import glob
+import hashlib
+import http.client
+import itertools
 import os
+import re
+import shlex
+import stat
+import subprocess
+import threading
 import time
 import shutil
 import tarfile
 import tempfile
+import urllib.parse
 from ruamel.yaml.scalarstring import DoubleQuotedScalarString
 import ruamel.yaml
 import yaml
 
-from utilities.cmd_common import execute_command
 from utilities import logutil
 from utilities.netrc_common import NetRCCredsGetter
-from helmpython.helm_chart import HelmChart
 from helmpython.helm_chart import Credentials
 
 LOGGER = logutil.get_logger(__name__)
 
 SUPPORTED_HELM_VERSIONS = enum.Enum('SUPPORTED_HELM_VERSIONS', 'V3')
 TIMEOUT = 240
+HTTP_CHUNK_SIZE = 64 * 1024
+HTTP_REDIRECTS = (301, 302, 303, 307, 308)
+CHART_CONTEXT_CACHE_SIZE = 64
+PREFETCH_WORKERS = 4
+OUTPUT_TAIL_SIZE = 64 * 1024
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+class _IndexLoader(YAML_LOADER):
+    # pylint: disable=too-many-ancestors
+    """
+    Keep index.yaml timestamps as strings, helm writes nanoseconds
+    that datetime can not round trip
+    """
+
+
+_IndexLoader.add_constructor("tag:yaml.org,2002:timestamp",
+                             yaml.SafeLoader.construct_yaml_str)
+
+
+class _IndexDumper(YAML_DUMPER):
+    # pylint: disable=too-many-ancestors
+    """
+    Quote strings that YAML 1.2 parsers, like helm, would read as numbers,
+    e.g. an appVersion of 1e3
+    """
+
+
+_SEMVER = r"v?[0-9]+\.[0-9]+\.[0-9]+(-[0-9A-Za-z.-]+)?(\+[0-9A-Za-z.-]+)?"
+_EXACT_VERSION = re.compile(f"^{_SEMVER}$")
+_YAML12_NUMBER = re.compile(
+    r"^[-+]?(\.[0-9]+|[0-9]+(\.[0-9]*)?)([eE][-+]?[0-9]+)?$")
+_IndexDumper.add_representer(
+    str, lambda dumper, data: dumper.represent_scalar(
+        "tag:yaml.org,2002:str", data,
+        style='"' if _YAML12_NUMBER.match(data) else None))
+
+_NETRC_CACHE = {}
+_NETRC_CACHE_LOCK = threading.Lock()
+_OUTPUT_LOG_COUNTER = itertools.count()
 
 
 ###############################################################################
@@ -90,34 +142,6 @@ def _cleanup_old_folder(clean_dir):
                 f"exception is: {str(helm_except)}") from helm_except
 
 
-###############################################################################
-def _resolve_package_name(helm_chart: HelmChart, package_name: 'str | None'):
-    """
-    This function takes a helm chart and a package name
-    and returns the name for the helm package .tgz.
-
-    Params
-    ---------------------------------------------------------------
-    helm_chart: HelmChart
-        A HelmChart object.
-
-    package_name: str | None
-        A specified name for the package. Can be None.
-
-    Returns
-    ----------------------------------------------------------------
-    str
-        package_name if it was not None, otherwise the
-        name found in Chart.yaml.
-    """
-    # This function exists to please pylint
-    if package_name is None:
-        chart_name = helm_chart.name
-    else:
-        chart_name = package_name
-    return chart_name
-
-
 ###############################################################################
 def _get_workspace_destination(workspace, destination):
     if not workspace:
@@ -135,6 +159,208 @@ def _get_workspace_destination(workspace, destination):
     return workspace, destination
 
 
+###############################################################################
+def execute_helm_command(cmd, cwd=None, verbose=False, mask=None, retries=0,
+                         timeout=None, consumers=None, log_file=None,
+                         tail_size=OUTPUT_TAIL_SIZE):
+    # pylint: disable=too-many-arguments,too-many-locals
+    # pylint: disable=too-many-statements
+    """
+    Run a helm command and stream its output line by line, only the last
+    tail_size bytes of stdout and stderr are kept in memory.
+    A timeout gives return code 124, a kill by signal 128 + signal number,
+    like a shell does.
+    :arg cmd command line
+    :arg cwd working directory (default is current path)
+    :arg verbose log every output line while the command runs
+    :arg mask string replaced by ***** in the command and the output
+    :arg retries number of retries when the command fails
+    :arg timeout seconds before the command is killed, None to wait
+    :arg consumers callables called with ('stdout' or 'stderr', line) for
+         every line of every attempt. The output is still drained when a
+         consumer raises, the first exception is raised once the command
+         has ended.
+    :arg log_file file where the full output is appended, can be None
+    :arg tail_size bytes of stdout and stderr kept for error reporting
+    :returns HelmCommandResult
+    """
+    def masked(text):
+        if not mask:
+            return text
+        # Quoted form first, the command line holds shlex quoted secrets
+        return text.replace(shlex.quote(mask), '*****').replace(mask,
+                                                                '*****')
+
+    handlers = list(consumers or [])
+    if verbose:
+        handlers.append(lambda stream, line: (
+            LOGGER.info if stream == 'stdout' else LOGGER.warning)(
+                line.rstrip('\n')))
+    lock = threading.Lock()
+    failed_handlers = {}
+
+    def pump(stream, pipe, tail, sink):
+        # readline is bounded too, a huge line is delivered in chunks
+        for line in iter(lambda: pipe.readline(tail_size), ''):
+            line = masked(line)
+            with lock:
+                tail(line)
+                if sink:
+                    sink.write(line)
+                for handler in handlers:
+                    if handler in failed_handlers:
+                        continue
+                    try:
+                        handler(stream, line)
+                    except Exception as err:  # pylint: disable=W0703
+                        # Keep draining, a full pipe would block helm
+                        LOGGER.error("Output consumer failed, ignored for "
+                                     "the rest of the output: %s", err)
+                        failed_handlers[handler] = err
+
+    stdout_tail = _OutputTail(tail_size)
+    stderr_tail = _OutputTail(tail_size)
+    try:
+        argv = shlex.split(cmd)
+    except ValueError as err:
+        stderr_tail(f"Invalid command line: {err}\n")
+        return HelmCommandResult(2, str(stdout_tail), str(stderr_tail))
+
+    # pylint: disable=consider-using-with
+    sink = open(log_file, "a") if log_file else None
+    try:
+        for attempt in range(retries + 1):
+            if attempt:
+                LOGGER.warning("Retry %d/%d: %s", attempt, retries,
+                               masked(cmd))
+            LOGGER.debug("Execute: %s", masked(cmd))
+            if sink:
+                sink.write(f"$ {masked(cmd)}\n")
+            stdout_tail = _OutputTail(tail_size)
+            stderr_tail = _OutputTail(tail_size)
+            try:
+                process = subprocess.Popen(argv, cwd=cwd,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE,
+                                           universal_newlines=True,
+                                           errors='replace')
+            except OSError as err:
+                stderr_tail(f"{masked(str(err))}\n")
+                returncode = 127
+                continue
+            with process:
+                pumps = [threading.Thread(target=pump, args=args, daemon=True)
+                         for args in (('stdout', process.stdout,
+                                       stdout_tail, sink),
+                                      ('stderr', process.stderr,
+                                       stderr_tail, sink))]
+                for thread in pumps:
+                    thread.start()
+                try:
+                    returncode = process.wait(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                    returncode = 124
+                    stderr_tail(f"Killed after {timeout}s timeout\n")
+                for thread in pumps:
+                    thread.join()
+            if returncode < 0:
+                returncode = 128 - returncode
+            if failed_handlers:
+                raise next(iter(failed_handlers.values()))
+            if returncode == 0:
+                break
+    finally:
+        if sink:
+            sink.close()
+    return HelmCommandResult(returncode, str(stdout_tail), str(stderr_tail),
+                             log_file)
+
+
+###############################################################################
+def _restamp_released_chart(replace, chart_filename, destination):
+    """
+    Process pool worker of Helm.replace_in_released_chart_many, reads
+    name and version from Chart.yaml instead of helm inspect chart.
+    Returns the temporary package, its final path and the input size.
+    """
+    with tempfile.TemporaryDirectory() as path:
+        with tarfile.open(chart_filename, 'r') as tar:
+            tar.extractall(path)
+        folders = os.listdir(path)
+        if len(folders) != 1:
+            raise HelmCommonException("Not one folder in the tar file: "
+                                      f"{chart_filename}")
+        data = os.path.join(path, folders[0])
+        with open(os.path.join(data, 'Chart.yaml'), "r") as chart_file:
+            chart_data = yaml.safe_load(chart_file) or {}
+        chart_name = chart_data.get('name')
+        chart_version = chart_data.get('version')
+        if (not chart_name) or (not chart_version):
+            raise HelmCommonException("Failed to get chart name and chart "
+                                      "version from .tgz file: "
+                                      f"{chart_filename}")
+        # pylint: disable=protected-access
+        Helm._replace_in_chart(replace, data)
+
+        # Unique per input archive, two inputs may stamp the same package
+        package = os.path.join(destination,
+                               f"{chart_name}-{chart_version}.tgz")
+        input_id = hashlib.sha256(chart_filename.encode()).hexdigest()[:12]
+        tmp_package = f"{package}.{input_id}.tmp"
+        try:
+            with tarfile.open(tmp_package, "w:gz") as tar:
+                tar.add(data, arcname=folders[0])
+        except Exception:
+            os.remove(tmp_package)
+            raise
+    return tmp_package, package, os.path.getsize(chart_filename)
+
+
+###############################################################################
+def _read_chart_metadata(chart_folder):
+    chart_yaml_path = os.path.join(chart_folder, 'Chart.yaml')
+    if not os.path.exists(chart_yaml_path):
+        raise HelmCommonException("Chart.yaml does not exists: "
+                                  f"{chart_yaml_path}")
+    metadata = {}
+    for filename in ('Chart.yaml', 'requirements.yaml'):
+        path = os.path.join(chart_folder, filename)
+        if os.path.exists(path):
+            with open(path, "rb") as chart_file:
+                metadata[filename] = chart_file.read()
+    return metadata
+
+
+def _chart_metadata_digest(metadata):
+    sha = hashlib.sha256()
+    for filename, content in sorted(metadata.items()):
+        sha.update(filename.encode())
+        sha.update(content)
+    return sha.hexdigest()
+
+
+###############################################################################
+def _get_netrc_creds():
+    # Parsed once per NETRC file version, not once per helm call
+    netrc_path = os.environ.get("NETRC", '')
+    if not netrc_path:
+        return None
+    try:
+        key = (os.path.abspath(netrc_path), os.stat(netrc_path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    with _NETRC_CACHE_LOCK:
+        if key not in _NETRC_CACHE:
+            _NETRC_CACHE.clear()
+            try:
+                _NETRC_CACHE[key] = NetRCCredsGetter(netrc_path)
+            except FileNotFoundError:
+                return None
+        return _NETRC_CACHE[key]
+
+
 ###############################################################################
 def _print_helmversion_used(self):
     if self.version == SUPPORTED_HELM_VERSIONS.V3:
@@ -164,10 +390,16 @@ class Helm:
     """
 
     def __init__(self, workdir=None,
-                 version=SUPPORTED_HELM_VERSIONS.V3):
+                 version=SUPPORTED_HELM_VERSIONS.V3,
+                 output_tail_size=OUTPUT_TAIL_SIZE,
+                 output_log_dir=None):
         """
         :arg stable the stable helm repository url
         :arg workdir work directory
+        :arg output_tail_size bytes of stdout and stderr kept per helm call
+             for error reporting, the rest is only streamed
+        :arg output_log_dir folder where the full output of every helm call
+             is written, None to not keep it
         """
 
         if version not in SUPPORTED_HELM_VERSIONS:
@@ -176,6 +408,9 @@ class Helm:
         self.version = version
         self.helm_cmd = None
         self.file_repos = []
+        self._http_transport = None
+        self.output_tail_size = output_tail_size
+        self.output_log_dir = output_log_dir
         if os.environ.get("HELM_HOME") is not None:
             self.home = os.environ["HELM_HOME"]
         elif workdir is not None:
@@ -190,7 +425,7 @@ class Helm:
             self.__init_v3()
 
         cmd = f"{self.helm_cmd} version --client"
-        response = execute_command(cmd, verbose=True, timeout=TIMEOUT)
+        response = self._execute(cmd, verbose=True, timeout=TIMEOUT)
         if response.returncode > 0:
             raise Exception("Failed to construct Helm client wrapper")
 
@@ -228,15 +463,36 @@ class Helm:
         self.v3_settings_str = ''.join(
             f' --{k}={v}' for k, v in self.v3_settings.items())
 
+    def _execute(self, cmd, cwd=None, verbose=False, mask=None, retries=0,
+                 timeout=None, consumers=None):
+        # pylint: disable=too-many-arguments
+        log_file = None
+        if self.output_log_dir:
+            os.makedirs(self.output_log_dir, exist_ok=True)
+            log_file = os.path.join(
+                self.output_log_dir,
+                f"helm-{time.strftime('%Y%m%d-%H%M%S')}-"
+                f"{os.getpid()}-{next(_OUTPUT_LOG_COUNTER)}.log")
+        return execute_helm_command(cmd, cwd=cwd, verbose=verbose,
+                                    mask=mask, retries=retries,
+                                    timeout=timeout, consumers=consumers,
+                                    log_file=log_file,
+                                    tail_size=self.output_tail_size)
+
+    def _get_http_transport(self):
+        if self._http_transport is None:
+            self._http_transport = HelmHttpTransport(self.version)
+        return self._http_transport
+
     def repo_update(self):
         """
         Run helm repo update
         """
         cmd = f"{self.helm_cmd} repo update"
-        if execute_command(cmd,
-                           verbose=True,
-                           retries=2,
-                           timeout=TIMEOUT).returncode > 0:
+        if self._execute(cmd,
+                         verbose=True,
+                         retries=2,
+                         timeout=TIMEOUT).returncode > 0:
             raise HelmCommonException("Helm repo add failed")
 
     def repo_add(self, url, name=None, username=None, password=None):
@@ -262,16 +518,17 @@ class Helm:
         if username and password:
             authstr = (
                 (' --username {username} --password {password}').format(
-                    username=username, password=password))
+                    username=shlex.quote(username),
+                    password=shlex.quote(password)))
             maskstr = password
             authstr = f' --pass-credentials{authstr}'
 
         cmd = (f"{self.helm_cmd} repo add {name} {url}{authstr}")
         _print_helmversion_used(self)
-        if execute_command(cmd,
-                           verbose=True,
-                           mask=maskstr,
-                           timeout=TIMEOUT).returncode > 0:
+        if self._execute(cmd,
+                         verbose=True,
+                         mask=maskstr,
+                         timeout=TIMEOUT).returncode > 0:
             raise HelmCommonException("Helm repo add failed")
         LOGGER.info("Successfully added %s with name %s", url, name)
         return name
@@ -296,6 +553,79 @@ class Helm:
                 tar.add(data, arcname=os.path.basename(data))
         return pack_name
 
+    def replace_in_released_chart_many(self, replace, chart_filenames,
+                                       destination=None, workers=None):
+        """
+        Apply the same replace rules to many released helm tgz packages
+        in a process pool. A failing archive is reported, not raised.
+        Returns a ReleasedChartBatchResult.
+        :arg replace replace given parameters, see replace_in_released_chart
+        :arg chart_filenames released helm tgz packages
+        :arg destination folder of the new packages (default is the folder
+             of each package)
+        :arg workers number of processes (default is the available cores)
+        """
+        chart_filenames = list(dict.fromkeys(
+            os.path.realpath(chart_filename)
+            for chart_filename in chart_filenames))
+        if destination:
+            destination = os.path.abspath(destination)
+            os.makedirs(destination, exist_ok=True)
+        if not workers:
+            workers = (len(os.sched_getaffinity(0))
+                       if hasattr(os, "sched_getaffinity")
+                       else os.cpu_count())
+        workers = max(1, min(workers, len(chart_filenames)))
+        batch = ReleasedChartBatchResult()
+        start = time.monotonic()
+
+        stamped = []
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers) as executor:
+            futures = [
+                executor.submit(_restamp_released_chart, replace,
+                                chart_filename,
+                                destination or os.path.dirname(
+                                    chart_filename))
+                for chart_filename in chart_filenames]
+            for chart_filename, future in zip(chart_filenames, futures):
+                try:
+                    stamped.append((chart_filename, *future.result()))
+                except Exception as helm_except:  # pylint: disable=W0703
+                    batch.failures[chart_filename] = str(helm_except)
+
+        # Rename once every worker is done, so that no new package
+        # replaces an input archive that is still being read
+        owners = {}
+        for chart_filename, tmp_package, package, size in stamped:
+            try:
+                if package in owners:
+                    batch.failures[chart_filename] = (
+                        f"{package} is also the output of {owners[package]}")
+                else:
+                    os.replace(tmp_package, package)
+                    owners[package] = chart_filename
+                    batch.results[chart_filename] = package
+                    batch.bytes_in += size
+            except OSError as err:
+                batch.failures[chart_filename] = str(err)
+            finally:
+                if os.path.exists(tmp_package):
+                    try:
+                        os.remove(tmp_package)
+                    except OSError as err:
+                        LOGGER.warning("Failed to remove %s: %s",
+                                       tmp_package, err)
+
+        batch.elapsed = time.monotonic() - start
+        LOGGER.info("Re-stamped %d/%d charts in %.1fs with %d processes "
+                    "(%.1f charts/s, %.1f MB/s)", len(batch.results),
+                    len(chart_filenames), batch.elapsed, workers,
+                    batch.charts_per_second, batch.throughput / 1e6)
+        for chart_filename, error in batch.failures.items():
+            LOGGER.error("Failed to re-stamp %s: %s", chart_filename, error)
+        return batch
+
     def get_repo_name(self, repository):
         """
         Return the helm repo name stored in local cache
@@ -322,25 +652,21 @@ class Helm:
 
         """
 
-        # Below code, get the first line match the "name: "
-        # And .split(' ')[1], here index "1" means the second work
-        # of the match line string, here is the <name>
-        chart_name = list(
-            filter(
-                lambda x: x.startswith('name: '),
-                execute_command(
-                    f"{self.helm_cmd} inspect chart " +
-                    chart_archive,
-                    timeout=TIMEOUT
-                ).stdout.split('\n')))[0].split(' ')[1]
+        # Keep the value part of the first line starting with "name: "
+        # and "version: ", the rest of the output is not retained
+        fields = {}
 
-        chart_version = list(
-            filter(
-                lambda x: x.startswith('version: '),
-                execute_command(
-                    f"{self.helm_cmd} inspect chart {chart_archive}",
-                    timeout=TIMEOUT
-                ).stdout.split('\n')))[0].split(' ')[1]
+        def parse_line(stream, line):
+            if stream != 'stdout':
+                return
+            for key in ('name', 'version'):
+                if key not in fields and line.startswith(f"{key}: "):
+                    fields[key] = line.rstrip('\n').split(' ')[1]
+
+        self._execute(f"{self.helm_cmd} inspect chart {chart_archive}",
+                      timeout=TIMEOUT, consumers=[parse_line])
+        chart_name = fields.get('name')
+        chart_version = fields.get('version')
 
         if (not chart_name) or (not chart_version):
             raise HelmCommonException("Failed to get chart name and chart "
@@ -383,17 +709,15 @@ class Helm:
         while retry_local > 0:
             self.repo_update()
 
-            _r = execute_command(cmd, verbose=True, timeout=TIMEOUT)
+            parser = _SearchVersionParser(version)
+            _r = self._execute(cmd, verbose=True, timeout=TIMEOUT,
+                               consumers=[parser])
             if _r.returncode != 0:
                 raise HelmCommonException("Helm repo search failed")
 
-            chart_versions = yaml.safe_load(_r.stdout)
-            if isinstance(chart_versions, list):
-                for chart_version in chart_versions:
-                    # Helm 3 uses all lowercase keys
-                    if (version == chart_version.get("version") or
-                            version == chart_version.get("Version")):
-                        return chart_version
+            chart_version = parser.finish()
+            if chart_version is not None:
+                return chart_version
 
             retry_local -= 1
             time.sleep(3)
@@ -411,7 +735,8 @@ class Helm:
                 helm_user=None,
                 helm_token=None,
                 retries=2,
-                skip_dep_update=False):
+                skip_dep_update=False,
+                prefetch_dependencies=False):
         # pylint: disable=too-many-arguments,too-many-locals
         """
         Run helm package command
@@ -426,6 +751,9 @@ class Helm:
         :arg helm_token helm password, lower prio then repo_cred_path
         :arg retries number of retries when executing the package command
         :arg skip_dep_update skip dependency update during packaging
+        :arg prefetch_dependencies download the dependency archives in the
+             background while the chart is staged, and hand helm a filled
+             charts/ folder instead of running the dependency update
         """
         if not os.path.exists(helm_chart_folder):
             raise AttributeError("Helm chart folder does not exists"
@@ -434,16 +762,41 @@ class Helm:
         workspace, destination = _get_workspace_destination(workspace,
                                                             destination)
 
-        # repo add check credential, single repo credential
-        # or use helm_user and helm_token globally, or no user/pass
-        self._repo_add_credential(helm_chart_folder, repo_cred_path,
-                                  helm_user, helm_token)
-
-        chart = HelmChart.load_chart(helm_chart_folder)
+        # Chart.yaml, dependencies and repositories, parsed once
+        chart_context = HelmChartContext.load(helm_chart_folder)
+
+        # A credentials file registers its repositories in helm's
+        # repositories.yaml, the downloads can only start once it is done.
+        # Otherwise they overlap the repo add with the same credentials.
+        cred_file = bool(repo_cred_path and os.path.exists(repo_cred_path))
+        if cred_file:
+            self._repo_add_credential(chart_context, repo_cred_path,
+                                      helm_user, helm_token)
+
+        dependencies = []
+        if prefetch_dependencies and not skip_dep_update:
+            dependencies = _DependencyPrefetch.prefetchable(chart_context)
+
+        with _DependencyPrefetch(self._get_http_transport, dependencies,
+                                 helm_user, helm_token,
+                                 registered=cred_file) as prefetch:
+            if not cred_file:
+                # repo add check credential, use helm_user and helm_token
+                # globally, or netrc, or no user/pass
+                self._repo_add_credential(chart_context, repo_cred_path,
+                                          helm_user, helm_token)
+            return self._package_staged(
+                chart_context, prefetch, helm_chart_folder, new_version,
+                helm_package_name, app_version, destination, replace,
+                workspace, retries, skip_dep_update)
+
+    def _package_staged(self, chart_context, prefetch, helm_chart_folder,
+                        new_version, helm_package_name, app_version,
+                        destination, replace, workspace, retries,
+                        skip_dep_update):
+        # pylint: disable=too-many-arguments,too-many-locals
         # Get chart name
-        chart_name = _resolve_package_name(
-            chart, helm_package_name
-        )
+        chart_name = chart_context.package_name(helm_package_name)
 
         # Chart package path
         chart_package = os.path.join(destination,
@@ -473,6 +826,9 @@ class Helm:
             if replace:
                 Helm._replace_in_chart(replace, tmp_chart_folder)
 
+            if prefetch.fill(tmp_chart_folder):
+                skip_dep_update = True
+
             # Run helm package
             if self.version == SUPPORTED_HELM_VERSIONS.V3:
                 cmd = (f"{self.helm_cmd} package "
@@ -486,11 +842,11 @@ class Helm:
                 cmd += f" --app-version {_add_double_quotes(app_version)}"
             cmd += f" {tmp_chart_folder}"
             _print_helmversion_used(self)
-            response = execute_command(cmd,
-                                       workspace,
-                                       True,
-                                       retries=retries,
-                                       timeout=None)
+            response = self._execute(cmd,
+                                     workspace,
+                                     True,
+                                     retries=retries,
+                                     timeout=None)
 
             if response.returncode > 0:
                 LOGGER.error("helm package command failed!")
@@ -498,6 +854,8 @@ class Helm:
                 LOGGER.error(response.stderr)
                 LOGGER.error(" ======= stdout ======= ")
                 LOGGER.error(response.stdout)
+                if response.log_file:
+                    LOGGER.error("Full output in %s", response.log_file)
                 return None
 
             # Return result
@@ -505,12 +863,11 @@ class Helm:
                 LOGGER.info("Successfully created package %s",
                             chart_package)
                 app_version_latest = app_version
-                chart_data = _get_data_from_chart(helm_chart_folder)
-                if (not app_version) and ('appVersion' in chart_data):
-                    app_version_latest = chart_data['appVersion']
+                if (not app_version) and chart_context.app_version:
+                    app_version_latest = chart_context.app_version
 
                 if app_version_latest:
-                    _add_quote_app_version(workspace, chart.name,
+                    _add_quote_app_version(workspace, chart_context.name,
                                            chart_package, app_version_latest)
                     LOGGER.info("Successfully modify 'app-version'")
                 return chart_package
@@ -525,30 +882,22 @@ class Helm:
             shutil.copytree(repo_dir, tmp_repo_folder)
 
     def _repo_add_credential(self,
-                             helm_chart_folder,
+                             chart_context,
                              repo_cred_path,
                              helm_user,
                              helm_token):
-        # Get dependencies
-        chart = HelmChart.load_chart(helm_chart_folder)
-        netrc_path = os.environ.get("NETRC", '')
-        try:
-            netrc_creds = NetRCCredsGetter(netrc_path)
-        except FileNotFoundError:
-            netrc_creds = None
-        repo_cred = None
-        for url in chart.repositories:
-            if repo_cred_path and os.path.exists(repo_cred_path):
-                repo_cred = Credentials(repo_cred_path)
-                repo_cred.register_repos(self)
-                if should_url_be_copied(url):
-                    self.file_repos.append(url[7:])
-            elif should_url_be_copied(url):
-                self.file_repos.append(url[7:])
-            elif helm_user and helm_token:
+        netrc_creds = _get_netrc_creds()
+        self.file_repos = list(chart_context.file_repos)
+        if (chart_context.repositories and repo_cred_path and
+                os.path.exists(repo_cred_path)):
+            Credentials(repo_cred_path).register_repos(self)
+            return
+        for url in chart_context.repositories:
+            if should_url_be_copied(url):
+                continue
+            if helm_user and helm_token:
                 self.repo_add(url, username=helm_user, password=helm_token)
-            elif (not helm_user and not helm_token and
-                  netrc_path and
+            elif (not helm_user and not helm_token and netrc_creds and
                   (netrc_creds.is_hostname_exists(url.split('/')[2])
                    or netrc_creds.is_default_exists())):
                 hostname = url.split('/')[2]
@@ -574,7 +923,7 @@ class Helm:
             if not os.path.isfile(file_in):
                 raise HelmCommonException("File not exist: {file}"
                                           .format(file=file_in))
-            file_out = "tmp_value.yaml"
+            file_out = f"{file_in}.tmp"
             with open(file_in, "rt") as fin, open(file_out, "wt") as fout:
                 for line in fin:
                     fout.write(line.replace(from_value, to_value))
@@ -588,7 +937,8 @@ class Helm:
               workspace=None,
               helm_user=None,
               helm_token=None,
-              retries=0):
+              retries=0,
+              native=False):
         # pylint: disable=too-many-arguments
         """
         Run helm fetch command
@@ -598,6 +948,8 @@ class Helm:
         :arg workspace folder (default is current path)
         :arg helm_user helm user, lower prio then repo_cred_path
         :arg helm_token helm password, lower prio then repo_cred_path
+        :arg native download over pooled HTTP connections instead of
+             running helm fetch
         """
         if workspace is None:
             workspace = os.getcwd()
@@ -606,12 +958,25 @@ class Helm:
         if not os.path.exists(workspace):
             os.makedirs(workspace)
 
+        if native:
+            try:
+                archive = self._get_http_transport().fetch(
+                    chart_name, version, repo, workspace,
+                    helm_user=helm_user, helm_token=helm_token,
+                    retries=retries)
+            except HelmCommonException as helm_except:
+                LOGGER.error("native fetch failed: %s", helm_except)
+                return None
+            LOGGER.info("Archive successfully fetched: %s", archive)
+            return archive
+
         authstr = ''
         maskstr = None
         if helm_user and helm_token:
             self.repo_add(repo, username=helm_user, password=helm_token)
             time.sleep(2)
-            authstr = f" --username {helm_user} --password {helm_token}"
+            authstr = (f" --username {shlex.quote(helm_user)}"
+                       f" --password {shlex.quote(helm_token)}")
             maskstr = helm_token
             authstr = f' --pass-credentials{authstr}'
 
@@ -620,11 +985,11 @@ class Helm:
                f"{version} {authstr} --destination {workspace}")
 
         _print_helmversion_used(self)
-        response = execute_command(cmd,
-                                   verbose=True,
-                                   mask=maskstr,
-                                   timeout=TIMEOUT,
-                                   retries=retries)
+        response = self._execute(cmd,
+                                 verbose=True,
+                                 mask=maskstr,
+                                 timeout=TIMEOUT,
+                                 retries=retries)
 
         if response.returncode > 0:
             LOGGER.error("helm fetch command failed!")
@@ -632,6 +997,8 @@ class Helm:
             LOGGER.error(response.stderr)
             LOGGER.error(" ======= stdout ======= ")
             LOGGER.error(response.stdout)
+            if response.log_file:
+                LOGGER.error("Full output in %s", response.log_file)
             return None
 
         results = []
@@ -653,7 +1020,11 @@ class Helm:
                     workspace=None,
                     helm_user=None,
                     helm_token=None,
-                    retries=0):
+                    retries=0,
+                    native=False,
+                    members=None,
+                    in_memory=False,
+                    recurse_subcharts=False):
         # pylint: disable=too-many-arguments
         """
         Run helm package command
@@ -663,20 +1034,66 @@ class Helm:
         :arg workspace folder (default is current path)
         :arg helm_user helm user, lower prio then repo_cred_path
         :arg helm_token helm password, lower prio then repo_cred_path
+        :arg native download over pooled HTTP connections instead of
+             running helm fetch
+        :arg members glob patterns, only extract the matching chart members,
+             see extract_chart_members
+        :arg in_memory return the matching members as a dict of path to
+             bytes instead of writing them into workspace
+        :arg recurse_subcharts also match members of charts/*.tgz subcharts
         """
         if workspace is None:
             workspace = os.getcwd()
         else:
             workspace = os.path.abspath(workspace)
-        if not os.path.exists(workspace):
+        in_memory = bool(members) and in_memory
+        if not in_memory and not os.path.exists(workspace):
             os.makedirs(workspace)
 
+        if members:
+            with tempfile.TemporaryDirectory() as download_dir:
+                archive = self.fetch(chart_name, version, repo,
+                                     workspace=download_dir,
+                                     helm_user=helm_user,
+                                     helm_token=helm_token,
+                                     retries=retries,
+                                     native=native)
+                if archive is None:
+                    return None
+                try:
+                    extracted = extract_chart_members(
+                        archive, members, None if in_memory else workspace,
+                        recurse_subcharts)
+                except (HelmCommonException, tarfile.TarError) as helm_except:
+                    LOGGER.error("Failed to extract %s members: %s",
+                                 chart_name, helm_except)
+                    return None
+            LOGGER.info("Successfully extract %d members of %s with %s",
+                        len(extracted), chart_name, version)
+            return extracted if in_memory else chart_name
+
+        if native:
+            with tempfile.TemporaryDirectory() as download_dir:
+                try:
+                    archive = self._get_http_transport().fetch(
+                        chart_name, version, repo, download_dir,
+                        helm_user=helm_user, helm_token=helm_token,
+                        retries=retries)
+                    # Rejects members escaping the workspace, like helm does
+                    extract_chart_members(archive, "**", workspace)
+                except (HelmCommonException, tarfile.TarError) as helm_except:
+                    LOGGER.error("native fetch failed: %s", helm_except)
+                    return None
+            LOGGER.info("Successfully fetch %s with %s", chart_name, version)
+            return chart_name
+
         authstr = ''
         maskstr = None
         if helm_user and helm_token:
             self.repo_add(repo, username=helm_user, password=helm_token)
             time.sleep(2)
-            authstr = f" --username {helm_user} --password {helm_token}"
+            authstr = (f" --username {shlex.quote(helm_user)}"
+                       f" --password {shlex.quote(helm_token)}")
             maskstr = helm_token
             authstr = f' --pass-credentials{authstr}'
 
@@ -685,11 +1102,11 @@ class Helm:
                f"{version} {authstr} --untar --untardir {workspace}")
 
         _print_helmversion_used(self)
-        response = execute_command(cmd,
-                                   verbose=True,
-                                   mask=maskstr,
-                                   timeout=TIMEOUT,
-                                   retries=retries)
+        response = self._execute(cmd,
+                                 verbose=True,
+                                 mask=maskstr,
+                                 timeout=TIMEOUT,
+                                 retries=retries)
 
         if response.returncode > 0:
             LOGGER.error("helm fetch command failed!")
@@ -697,12 +1114,355 @@ class Helm:
             LOGGER.error(response.stderr)
             LOGGER.error(" ======= stdout ======= ")
             LOGGER.error(response.stdout)
+            if response.log_file:
+                LOGGER.error("Full output in %s", response.log_file)
             return None
 
         LOGGER.info("Successfully fetch %s with %s", chart_name, version)
         return chart_name
 
 
+###############################################################################
+class HelmChartContext:
+    """
+    Chart folder data parsed once and shared by every Helm.package stage:
+    Chart.yaml, dependencies and repositories.
+    Contexts are cached by a digest of those files, so an unchanged chart
+    is not parsed again on the next call.
+    """
+
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, chart_folder, metadata=None):
+        """
+        :arg chart_folder helm chart folder
+        :arg metadata content of Chart.yaml and requirements.yaml, read
+             when None
+        """
+        self.chart_folder = os.path.abspath(chart_folder)
+        if metadata is None:
+            metadata = _read_chart_metadata(self.chart_folder)
+        self.digest = _chart_metadata_digest(metadata)
+        # Round trip load keeps appVersion as written, e.g. 1.10
+        self.chart_data = ruamel.yaml.round_trip_load(
+            metadata['Chart.yaml'].decode())
+        self.dependencies = self._load_dependencies(
+            metadata.get('requirements.yaml'))
+        self.repositories = list(dict.fromkeys(
+            str(dependency['repository'])
+            for dependency in self.dependencies
+            if dependency.get('repository')))
+        self.file_repos = [url[7:] for url in self.repositories
+                           if should_url_be_copied(url)]
+
+    @classmethod
+    def load(cls, chart_folder):
+        """
+        Return the cached context of a chart folder, parse it when the
+        chart metadata files changed
+        :arg chart_folder helm chart folder
+        """
+        chart_folder = os.path.abspath(chart_folder)
+        metadata = _read_chart_metadata(chart_folder)
+        digest = _chart_metadata_digest(metadata)
+        with cls._cache_lock:
+            context = cls._cache.get(chart_folder)
+        if context is not None and context.digest == digest:
+            LOGGER.debug("Chart context cache hit for %s", chart_folder)
+            return context
+
+        context = cls(chart_folder, metadata)
+        with cls._cache_lock:
+            cls._cache.pop(chart_folder, None)
+            if len(cls._cache) >= CHART_CONTEXT_CACHE_SIZE:
+                cls._cache.pop(next(iter(cls._cache)))
+            cls._cache[chart_folder] = context
+        return context
+
+    @property
+    def name(self):
+        """
+        Chart name from Chart.yaml
+        """
+        return self.chart_data.get('name')
+
+    @property
+    def app_version(self):
+        """
+        appVersion from Chart.yaml, None when not set
+        """
+        return self.chart_data.get('appVersion')
+
+    def package_name(self, helm_package_name=None):
+        """
+        Return the name of the helm package .tgz
+        :arg helm_package_name name overriding the chart name, can be None
+        """
+        if helm_package_name is None:
+            return self.name
+        return helm_package_name
+
+    def _load_dependencies(self, requirements):
+        # apiVersion v2 lists them in Chart.yaml, v1 in requirements.yaml
+        dependencies = self.chart_data.get('dependencies')
+        if not dependencies and requirements:
+            dependencies = (yaml.safe_load(requirements) or
+                            {}).get('dependencies')
+        return [dict(dependency) for dependency in dependencies or []]
+
+
+###############################################################################
+class _DependencyPrefetch:
+    """
+    Download the dependency archives of a chart in background threads,
+    used by Helm.package to overlap the downloads with chart staging
+    """
+
+    def __init__(self, get_transport, dependencies, helm_user=None,
+                 helm_token=None, registered=False):
+        # pylint: disable=too-many-arguments
+        """
+        :arg get_transport callable returning the HelmHttpTransport
+        :arg dependencies Chart.yaml dependencies to download, may be empty
+        :arg helm_user ARM username
+        :arg helm_token ARM api token
+        :arg registered the repositories are already registered in helm's
+             repositories.yaml with their credentials, use those
+        """
+        self.get_transport = get_transport
+        self.dependencies = dependencies
+        self.helm_user = helm_user
+        self.helm_token = helm_token
+        self.registered = registered
+        self._download_dir = None
+        self._executor = None
+        self._futures = []
+
+    @staticmethod
+    def prefetchable(chart_context):
+        """
+        Return the chart dependencies when all of them can be downloaded
+        without helm, an empty list otherwise: helm would download every
+        dependency again anyway when any of them is left to it.
+        :arg chart_context HelmChartContext of the chart
+        """
+        for dependency in chart_context.dependencies:
+            repository = str(dependency.get('repository') or '')
+            if (not repository.startswith(('http://', 'https://')) or
+                    not _EXACT_VERSION.match(
+                        str(dependency.get('version') or ''))):
+                LOGGER.info("Dependency %s can not be prefetched, "
+                            "helm dependency update is used",
+                            dependency.get('name'))
+                return []
+        return chart_context.dependencies
+
+    def __enter__(self):
+        if self.dependencies:
+            transport = self.get_transport()
+            # pylint: disable=consider-using-with
+            self._download_dir = tempfile.TemporaryDirectory()
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(PREFETCH_WORKERS, len(self.dependencies)))
+            self._futures = []
+            for dependency in self.dependencies:
+                helm_user, helm_token = self._credentials(
+                    dependency['repository'])
+                self._futures.append(self._executor.submit(
+                    transport.fetch, dependency['name'],
+                    str(dependency['version']), dependency['repository'],
+                    self._download_dir.name, helm_user=helm_user,
+                    helm_token=helm_token))
+            LOGGER.info("Prefetching %d dependencies",
+                        len(self.dependencies))
+        return self
+
+    def _credentials(self, repository):
+        # Same choice as Helm._repo_add_credential, resolved up front so
+        # the downloads do not read repositories.yaml while helm rewrites it
+        if self.registered:
+            return None, None
+        if self.helm_user and self.helm_token:
+            return self.helm_user, self.helm_token
+        netrc_creds = _get_netrc_creds()
+        hostname = urllib.parse.urlsplit(repository).hostname
+        if (not self.helm_user and not self.helm_token and netrc_creds and
+                (netrc_creds.is_hostname_exists(hostname) or
+                 netrc_creds.is_default_exists())):
+            username, _, password = netrc_creds.get_credentials(hostname)
+            return username, password
+        return None, None
+
+    def __exit__(self, *exc_info):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        if self._download_dir is not None:
+            self._download_dir.cleanup()
+
+    def fill(self, chart_folder):
+        """
+        Wait for the downloads and move the archives into the charts/
+        folder, replacing other versions of the same dependencies.
+        Returns True when every dependency is in place, False when helm
+        has to update them: a download failed or the replace rules
+        changed the dependencies of the staged chart.
+        :arg chart_folder staged chart folder
+        """
+        if not self._futures:
+            return False
+        staged = HelmChartContext(chart_folder).dependencies
+        if ([_dependency_key(dependency) for dependency in staged] !=
+                [_dependency_key(dependency)
+                 for dependency in self.dependencies]):
+            LOGGER.info("Dependencies changed while staging the chart, "
+                        "helm dependency update is used")
+            return False
+        archives = []
+        for dependency, future in zip(self.dependencies, self._futures):
+            try:
+                archives.append(future.result())
+            except Exception as helm_except:  # pylint: disable=broad-except
+                # helm gets another chance at any download failure
+                LOGGER.warning("Prefetch of %s failed, helm dependency "
+                               "update is used: %s",
+                               dependency['name'], helm_except)
+                return False
+
+        charts_folder = os.path.join(chart_folder, 'charts')
+        os.makedirs(charts_folder, exist_ok=True)
+        # <name>-<semver>.tgz only, dep-extra-1.0.0.tgz is not a dep archive
+        outdated = re.compile("|".join(
+            f"{re.escape(dependency['name'])}-{_SEMVER}\\.tgz"
+            for dependency in self.dependencies))
+        for archive in os.listdir(charts_folder):
+            if outdated.fullmatch(archive):
+                os.remove(os.path.join(charts_folder, archive))
+        for archive in archives:
+            shutil.move(archive, charts_folder)
+        LOGGER.info("Prefetched dependencies in place: %s",
+                    ", ".join(os.path.basename(archive)
+                              for archive in archives))
+        return True
+
+
+def _dependency_key(dependency):
+    return (str(dependency.get('name')), str(dependency.get('version')),
+            str(dependency.get('repository') or ''))
+
+
+###############################################################################
+class ReleasedChartBatchResult:
+    """
+    Outcome of Helm.replace_in_released_chart_many
+    """
+
+    def __init__(self):
+        # archive path -> new package path
+        self.results = {}
+        # archive path -> error message
+        self.failures = {}
+        self.elapsed = 0.0
+        self.bytes_in = 0
+
+    @property
+    def charts_per_second(self):
+        """
+        Re-stamped charts per second
+        """
+        return len(self.results) / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def throughput(self):
+        """
+        Re-stamped archive bytes per second
+        """
+        return self.bytes_in / self.elapsed if self.elapsed else 0.0
+
+
+###############################################################################
+class HelmCommandResult:
+    """
+    Result of a streamed helm call, stdout and stderr only hold the last
+    tail_size bytes of each stream
+    """
+
+    def __init__(self, returncode, stdout, stderr, log_file=None):
+        """
+        :arg returncode process exit code
+        :arg stdout last part of the standard output
+        :arg stderr last part of the standard error
+        :arg log_file file holding the full output, can be None
+        """
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.log_file = log_file
+
+
+###############################################################################
+class _OutputTail:
+    """
+    Ring buffer of the last lines of a stream, bounded in bytes
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lines = collections.deque()
+        self.size = 0
+
+    def __call__(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        while self.size > self.max_size and len(self.lines) > 1:
+            self.size -= len(self.lines.popleft())
+
+    def __str__(self):
+        return ''.join(self.lines)
+
+
+###############################################################################
+class _SearchVersionParser:
+    """
+    Consumer of helm search --output yaml, parses one list item at a time
+    and only keeps the item matching the version
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.item = []
+        self.match = None
+
+    def __call__(self, stream, line):
+        if stream != 'stdout' or self.match is not None:
+            return
+        if line.startswith('- '):
+            self._parse_item()
+        self.item.append(line)
+
+    def finish(self):
+        """
+        Return the matching search result, None when there is none
+        """
+        self._parse_item()
+        return self.match
+
+    def _parse_item(self):
+        if self.item and self.match is None:
+            try:
+                chart_versions = yaml.safe_load(''.join(self.item))
+            except yaml.YAMLError as err:
+                raise HelmCommonException(
+                    f"Invalid helm search output: {err}") from err
+            if isinstance(chart_versions, list):
+                for chart_version in chart_versions:
+                    # Helm 3 uses all lowercase keys
+                    if (self.version == chart_version.get("version") or
+                            self.version == chart_version.get("Version")):
+                        self.match = chart_version
+        self.item = []
+
+
 ###############################################################################
 class HelmRepositories:
     """
@@ -782,6 +1542,23 @@ class HelmRepositories:
                     return repo["name"]
         return None
 
+    def get_credentials(self, url):
+        """
+        Return the (username, password) registered with helm repo add
+        for the repository serving url, (None, None) when there is none
+        :arg url helm chart repository url, or a url below it
+        """
+        if self.version == SUPPORTED_HELM_VERSIONS.V3:
+            self.populate_in_memory_repositories_cache()
+
+        if self.repositories:
+            for repo in self.repositories.get("repositories") or []:
+                repo_url = (repo.get("url") or "").strip("/")
+                if repo_url and (url == repo_url or
+                                 url.startswith(f"{repo_url}/")):
+                    return repo.get("username"), repo.get("password")
+        return None, None
+
     def generate_name(self, repository):
         """
         Generate a repo name from the url given
@@ -803,6 +1580,422 @@ class HelmRepositories:
         return name
 
 
+###############################################################################
+class HelmHttpTransport:
+    """
+    Pure-Python chart transport, resolves archives from the repository
+    index.yaml and downloads them over pooled keep-alive connections
+    """
+
+    def __init__(self, version=SUPPORTED_HELM_VERSIONS.V3, timeout=TIMEOUT,
+                 max_redirects=5):
+        """
+        :arg version helm version, used to read helm registered credentials
+        :arg timeout socket timeout in seconds
+        :arg max_redirects number of redirects followed per request
+        """
+        self.version = version
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self._idle = {}
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        """
+        Close every idle connection of the pool
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def fetch(self, chart_name, version, repo, destination,
+              helm_user=None, helm_token=None, retries=0,
+              pass_credentials=False):
+        # pylint: disable=too-many-arguments
+        """
+        Download a chart archive and return its path
+        :arg chart_name
+        :arg version chart version
+        :arg repo from which repo to fetch
+        :arg destination folder where the archive is stored
+        :arg helm_user ARM username, higher prio then helm repo and netrc
+        :arg helm_token ARM api token, higher prio then helm repo and netrc
+        :arg retries number of retries, interrupted downloads are resumed
+        :arg pass_credentials also send the credentials to archive hosts
+             other than the repository host, like helm --pass-credentials
+        """
+        repo = repo.strip("/")
+        auth = self._get_auth(repo, helm_user, helm_token)
+        url, digest = self.resolve(chart_name, version, repo, auth)
+        repo_netloc = urllib.parse.urlsplit(repo).netloc
+        attempt = 0
+        while True:
+            try:
+                return self.download(url, destination, digest, auth,
+                                     auth_netloc=repo_netloc,
+                                     pass_credentials=pass_credentials)
+            except HelmCommonException as helm_except:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                LOGGER.warning("Download of %s failed, retry %d/%d: %s",
+                               url, attempt, retries, helm_except)
+
+    def resolve(self, chart_name, version, repo, auth=None):
+        """
+        Return the archive url and sha256 digest of a chart version
+        listed in the repository index.yaml
+        :arg chart_name
+        :arg version chart version
+        :arg repo the helm chart repository url
+        :arg auth Authorization header value, None for anonymous access
+        """
+        repo = repo.strip("/")
+        for refresh in (False, True):
+            entries = self.get_index(repo, auth, refresh).get("entries")
+            for entry in (entries or {}).get(chart_name) or []:
+                if (not isinstance(entry, dict) or
+                        str(entry.get("version")) != str(version)):
+                    continue
+                urls = entry.get("urls") or []
+                if not urls:
+                    raise HelmCommonException(
+                        f"No url listed for {chart_name}-{version} in {repo}")
+                return (urllib.parse.urljoin(f"{repo}/", urls[0]),
+                        entry.get("digest"))
+        raise HelmCommonException(
+            f"Chart {chart_name}-{version} not found in {repo}")
+
+    def get_index(self, repo, auth=None, refresh=False):
+        """
+        Return the parsed index.yaml of a repository, cached per instance
+        :arg repo the helm chart repository url
+        :arg auth Authorization header value, None for anonymous access
+        :arg refresh ignore the cached index
+        """
+        repo = repo.strip("/")
+        with self._lock:
+            index = None if refresh else self._indexes.get(repo)
+        if index is not None:
+            return index
+        conn, response = self._open(f"{repo}/index.yaml", auth)
+        try:
+            if response.status != 200:
+                raise HelmCommonException(
+                    f"Failed to get {repo}/index.yaml: HTTP {response.status}")
+            index = yaml.load(response.read(), Loader=_IndexLoader) or {}
+        except (http.client.HTTPException, OSError, yaml.YAMLError) as err:
+            raise HelmCommonException(
+                f"Failed to read {repo}/index.yaml: {err}") from err
+        finally:
+            self._finish(conn, response)
+        if (not isinstance(index, dict) or
+                not isinstance(index.get("entries") or {}, dict)):
+            raise HelmCommonException(
+                f"{repo}/index.yaml is not a helm repository index")
+        with self._lock:
+            self._indexes[repo] = index
+        return index
+
+    def download(self, url, destination, digest=None, auth=None,
+                 auth_netloc=None, pass_credentials=False):
+        # pylint: disable=too-many-arguments
+        """
+        Download url into destination and return the file path.
+        The data goes to a .part file first, an existing .part file is
+        resumed with a range request, and the sha256 digest is checked
+        while streaming.
+        :arg url archive url
+        :arg destination folder where the archive is stored
+        :arg digest expected sha256 hex digest, None to skip the check
+        :arg auth Authorization header value, None for anonymous access
+        :arg auth_netloc only host the credentials are sent to, default is
+             the host of url
+        :arg pass_credentials send the credentials to every host
+        """
+        filename = urllib.parse.unquote(
+            os.path.basename(urllib.parse.urlsplit(url).path))
+        if not filename:
+            raise HelmCommonException(f"No archive name in url: {url}")
+        target = os.path.join(destination, filename)
+        partial = f"{target}.part"
+
+        sha = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial):
+            with open(partial, "rb") as part_file:
+                for chunk in iter(lambda: part_file.read(HTTP_CHUNK_SIZE),
+                                  b""):
+                    sha.update(chunk)
+                    offset += len(chunk)
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+
+        conn, response = self._open(url, auth, headers, auth_netloc,
+                                    pass_credentials)
+        try:
+            if response.status == 416 and offset:
+                os.remove(partial)
+                return self.download(url, destination, digest, auth,
+                                     auth_netloc, pass_credentials)
+            if response.status == 206 and offset:
+                mode = "ab"
+            elif response.status == 200:
+                mode = "wb"
+                sha = hashlib.sha256()
+            else:
+                raise HelmCommonException(
+                    f"Failed to download {url}: HTTP {response.status}")
+            with open(partial, mode) as out_file:
+                for chunk in iter(lambda: response.read(HTTP_CHUNK_SIZE),
+                                  b""):
+                    sha.update(chunk)
+                    out_file.write(chunk)
+        except (http.client.HTTPException, OSError) as err:
+            raise HelmCommonException(
+                f"Download of {url} interrupted: {err}") from err
+        finally:
+            self._finish(conn, response)
+
+        if digest and sha.hexdigest() != digest:
+            os.remove(partial)
+            raise HelmCommonException(
+                f"Digest mismatch for {url}: expected {digest}, "
+                f"got {sha.hexdigest()}")
+        os.replace(partial, target)
+        return target
+
+    def _get_auth(self, url, helm_user=None, helm_token=None):
+        username, password = helm_user, helm_token
+        if not (username and password):
+            username, password = HelmRepositories(
+                self.version).get_credentials(url)
+        if not (username and password):
+            hostname = urllib.parse.urlsplit(url).hostname
+            netrc_creds = _get_netrc_creds()
+            if netrc_creds and (netrc_creds.is_hostname_exists(hostname) or
+                                netrc_creds.is_default_exists()):
+                username, _, password = netrc_creds.get_credentials(hostname)
+        if not (username and password):
+            return None
+        token = base64.b64encode(f"{username}:{password}".encode()).decode()
+        return f"Basic {token}"
+
+    def _open(self, url, auth=None, headers=None, auth_netloc=None,
+              pass_credentials=False):
+        # pylint: disable=too-many-arguments
+        """
+        GET url, following redirects, and return (connection, response).
+        Credentials are only sent to auth_netloc, default is the host of
+        url, unless pass_credentials is set.
+        """
+        auth_netloc = auth_netloc or urllib.parse.urlsplit(url).netloc
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                raise HelmCommonException(f"Unsupported url: {url}")
+            request_headers = dict(headers or {})
+            if auth and (pass_credentials or parts.netloc == auth_netloc):
+                request_headers["Authorization"] = auth
+            path = parts.path or "/"
+            if parts.query:
+                path = f"{path}?{parts.query}"
+            conn, response = self._request(parts, path, request_headers)
+            if response.status not in HTTP_REDIRECTS:
+                return conn, response
+            location = response.getheader("Location")
+            response.read()
+            self._finish(conn, response)
+            if not location:
+                raise HelmCommonException(f"Redirect without Location: {url}")
+            url = urllib.parse.urljoin(url, location)
+        raise HelmCommonException(f"Too many redirects: {url}")
+
+    def _request(self, parts, path, headers):
+        # A pooled keep-alive connection may have been closed by the server
+        # in the meantime, so retry once on a fresh connection
+        for attempt in range(2):
+            conn = self._acquire(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError) as err:
+                conn.close()
+                if attempt:
+                    raise HelmCommonException(
+                        f"HTTP request to {parts.netloc} failed: "
+                        f"{err}") from err
+        return None
+
+    def _acquire(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        conn.pool_key = (scheme, netloc)
+        return conn
+
+    def _finish(self, conn, response):
+        # Only a fully read response leaves the connection reusable
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.setdefault(conn.pool_key, []).append(conn)
+        else:
+            conn.close()
+
+
+###############################################################################
+class HelmRepoIndex:
+    """
+    Incremental helm repository index.yaml builder, the helm repo index
+    equivalent that only reads and hashes the newly packaged archives.
+    Without a shard folder write() still loads and dumps the whole
+    index.yaml, so a publish stays O(all charts) in YAML work.
+    With a shard folder every chart name is kept in its own
+    <chart>.yaml file, so a publish only loads and writes the shards of
+    the charts it touches. A chart without a shard yet starts from its
+    index.yaml entries, compact() merges the shards over index.yaml.
+    """
+
+    def __init__(self, index_path, base_url=None, shard_dir=None):
+        """
+        :arg index_path the repository index.yaml
+        :arg base_url url prefix of the archives, relative urls when None
+        :arg shard_dir folder of per chart index shards, None for a
+             single index.yaml
+        """
+        self.index_path = os.path.abspath(index_path)
+        self.base_url = base_url.strip("/") if base_url else None
+        self.shard_dir = None
+        if shard_dir:
+            self.shard_dir = self._check_shard_dir(shard_dir)
+        self.api_version = "v1"
+        self.entries = {}
+        self._loaded = set()
+        self._dirty = set()
+        self._full_loaded = False
+        self._index_document = None
+
+    def add_archives(self, archives):
+        """
+        Merge chart archives into the index, an existing entry with the
+        same name and version is replaced.
+        Returns the list of (name, version) merged.
+        :arg archives chart .tgz paths
+        """
+        merged = []
+        for archive in archives:
+            entry = _index_entry_from_archive(archive, self.base_url)
+            name, version = entry["name"], str(entry["version"])
+            versions = [existing for existing in self._get_entries(name)
+                        if str(existing.get("version")) != version]
+            versions.append(entry)
+            versions.sort(key=lambda item: _version_sort_key(
+                item.get("version")), reverse=True)
+            self.entries[name] = versions
+            self._dirty.add(name)
+            merged.append((name, version))
+            LOGGER.info("Index entry merged: %s-%s", name, version)
+        return merged
+
+    def write(self):
+        """
+        Atomically write the changed shards, or the whole index.yaml when
+        not sharded
+        """
+        if self.shard_dir:
+            os.makedirs(self.shard_dir, exist_ok=True)
+            for name in sorted(self._dirty):
+                _write_yaml_atomic(self._shard_path(name),
+                                   self._document({name: self.entries[name]}))
+        else:
+            self._load_full()
+            _write_yaml_atomic(self.index_path, self._document(self.entries))
+        self._dirty.clear()
+
+    def shard(self, shard_dir):
+        """
+        Split index.yaml into one shard per chart name and switch this
+        index to sharded mode
+        :arg shard_dir folder of per chart index shards
+        """
+        self._load_full()
+        self.shard_dir = self._check_shard_dir(shard_dir)
+        self._dirty = set(self.entries)
+        self._loaded = set(self.entries)
+        self.write()
+
+    def compact(self):
+        """
+        Merge every shard into a single atomically written index.yaml
+        """
+        if not self.shard_dir:
+            raise HelmCommonException("compact needs a shard folder")
+        self.write()
+        entries = dict(self._read_index()["entries"])
+        for shard in sorted(glob.glob(os.path.join(self.shard_dir,
+                                                   "*.yaml"))):
+            name = os.path.splitext(os.path.basename(shard))[0]
+            entries[name] = self._get_entries(name)
+        document = self._document(entries)
+        _write_yaml_atomic(self.index_path, document)
+        self._index_document = document
+
+    def _check_shard_dir(self, shard_dir):
+        # A shard next to index.yaml could be mistaken for it, or replace it
+        shard_dir = os.path.abspath(shard_dir)
+        if shard_dir == os.path.dirname(self.index_path):
+            raise HelmCommonException("The shard folder must not be the "
+                                      f"index.yaml folder: {shard_dir}")
+        return shard_dir
+
+    def _get_entries(self, name):
+        if self.shard_dir is None:
+            self._load_full()
+        elif name not in self._loaded:
+            shard = self._shard_path(name)
+            if os.path.exists(shard):
+                document = _load_index_yaml(shard)
+            else:
+                # Not sharded yet, the chart may only be in index.yaml
+                document = self._read_index()
+            self.entries[name] = list(document["entries"].get(name) or [])
+            self._loaded.add(name)
+        return self.entries.get(name) or []
+
+    def _read_index(self):
+        if self._index_document is None:
+            self._index_document = _load_index_yaml(self.index_path)
+            self.api_version = (self._index_document.get("apiVersion") or
+                                self.api_version)
+        return self._index_document
+
+    def _load_full(self):
+        if self._full_loaded:
+            return
+        for name, versions in self._read_index()["entries"].items():
+            # Keep entries merged before the load
+            if name not in self._dirty:
+                self.entries[name] = versions or []
+        self._full_loaded = True
+
+    def _shard_path(self, name):
+        return os.path.join(self.shard_dir, f"{name}.yaml")
+
+    def _document(self, entries):
+        return {
+            "apiVersion": self.api_version,
+            "entries": entries,
+            "generated": _rfc3339_now(),
+        }
+
+
 ###############################################################################
 class HelmCommonException(Exception):
     """
@@ -820,3 +2013,158 @@ def should_url_be_copied(url):
         if part_url.startswith('/') or part_url.startswith('..'):
             return True
     return False
+
+
+def extract_chart_members(chart_archive, patterns, destination=None,
+                          recurse_subcharts=False):
+    """
+    Stream a chart archive and extract only the members matching patterns.
+    Patterns are matched against the path relative to the chart folder one
+    "/" separated segment at a time: fnmatch wildcards stay inside a
+    segment, so "templates/*.yaml" does not match "templates/sub/b.yaml",
+    and a "**" segment matches any number of segments, e.g.
+    "templates/**/*.yaml" or "**" for every member.
+    :arg chart_archive chart .tgz path or readable binary file object
+    :arg patterns glob pattern or list of glob patterns
+    :arg destination folder to extract into, None keeps members in memory
+    :arg recurse_subcharts descend into charts/*.tgz subchart archives,
+         their members are matched as charts/<subchart>/<path>
+    :returns dict of member path to bytes when destination is None,
+             otherwise the list of extracted file paths
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if isinstance(chart_archive, (str, os.PathLike)):
+        with open(chart_archive, "rb") as fileobj:
+            return extract_chart_members(fileobj, patterns, destination,
+                                         recurse_subcharts)
+    patterns = [tuple(pattern.split("/")) for pattern in patterns]
+
+    extracted = {} if destination is None else []
+    for path, reader in _iter_chart_members(chart_archive, patterns,
+                                            recurse_subcharts):
+        if destination is None:
+            extracted[path] = reader.read()
+            continue
+        target = os.path.join(destination, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as out_file:
+            shutil.copyfileobj(reader, out_file)
+        extracted.append(target)
+    return extracted
+
+
+def _iter_chart_members(fileobj, patterns, recurse_subcharts, prefix=""):
+    # Stream mode only reads forward, the consumer must read each member
+    # before asking for the next one
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = os.path.normpath(member.name)
+            if os.path.isabs(name) or name.split(os.sep)[0] == "..":
+                raise HelmCommonException(
+                    f"Unsafe member path in chart archive: {member.name}")
+            path = f"{prefix}{name}"
+            chart_path = path.split("/", 1)[-1]
+            if (recurse_subcharts and
+                    os.path.basename(os.path.dirname(name)) == "charts" and
+                    name.endswith((".tgz", ".tar.gz"))):
+                subchart_prefix = f"{os.path.dirname(path)}/"
+                yield from _iter_chart_members(tar.extractfile(member),
+                                               patterns, recurse_subcharts,
+                                               subchart_prefix)
+            elif any(_match_chart_path(chart_path, pattern)
+                     for pattern in patterns):
+                yield path, tar.extractfile(member)
+
+
+def _match_chart_path(path, pattern):
+    segments = path.split("/")
+
+    def match(index, pattern_index):
+        if pattern_index == len(pattern):
+            return index == len(segments)
+        if pattern[pattern_index] == "**":
+            return any(match(start, pattern_index + 1)
+                       for start in range(index, len(segments) + 1))
+        return (index < len(segments) and
+                fnmatch.fnmatch(segments[index], pattern[pattern_index]) and
+                match(index + 1, pattern_index + 1))
+
+    return match(0, 0)
+
+
+def _index_entry_from_archive(archive, base_url):
+    chart_files = extract_chart_members(archive, "Chart.yaml")
+    if len(chart_files) != 1:
+        raise HelmCommonException(f"No Chart.yaml found in: {archive}")
+    entry = yaml.load(next(iter(chart_files.values())), Loader=_IndexLoader)
+    if not entry or "name" not in entry or "version" not in entry:
+        raise HelmCommonException(f"Invalid Chart.yaml in: {archive}")
+    # helm reads both as strings, whatever the Chart.yaml scalar type
+    for key in ("version", "appVersion"):
+        if entry.get(key) is not None:
+            entry[key] = str(entry[key])
+
+    sha = hashlib.sha256()
+    with open(archive, "rb") as archive_file:
+        for chunk in iter(lambda: archive_file.read(HTTP_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    filename = os.path.basename(archive)
+    entry["created"] = _rfc3339_now()
+    entry["digest"] = sha.hexdigest()
+    entry["urls"] = [f"{base_url}/{filename}" if base_url else filename]
+    return entry
+
+
+def _load_index_yaml(path):
+    if not os.path.exists(path):
+        return {"entries": {}}
+    with open(path, "r") as index_file:
+        document = yaml.load(index_file, Loader=_IndexLoader) or {}
+    document["entries"] = document.get("entries") or {}
+    return document
+
+
+def _write_yaml_atomic(path, document):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # NamedTemporaryFile is 0600, keep the mode a plain open() would give
+    if os.path.exists(path):
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp",
+                                     delete=False) as tmp_file:
+        try:
+            yaml.dump(document, tmp_file, Dumper=_IndexDumper,
+                      default_flow_style=False, sort_keys=True)
+        except Exception:
+            tmp_file.close()
+            os.remove(tmp_file.name)
+            raise
+    os.chmod(tmp_file.name, mode)
+    os.replace(tmp_file.name, path)
+
+
+def _rfc3339_now():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def _version_sort_key(version):
+    """
+    Semver ordering key, a release sorts above its pre-releases
+    """
+    version = str(version).lstrip("v").split("+", 1)[0]
+    core, _, prerelease = version.partition("-")
+    numbers = [int(part) if part.isdigit() else 0
+               for part in core.split(".")]
+    numbers += [0] * (3 - len(numbers))
+    if not prerelease:
+        return (tuple(numbers), (1,), version)
+    identifiers = tuple((0, int(part), "") if part.isdigit() else
+                        (1, 0, part) for part in prerelease.split("."))
+    return (tuple(numbers), (0, identifiers), version)
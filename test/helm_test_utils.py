@@ -0,0 +1,142 @@
+"""
+Helpers shared by the helm_common tests
+"""
+import http.server
+import io
+import os
+import re
+import sys
+import tarfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+def chart_archive(name, version, files=None, chart_yaml=None):
+    """
+    Return the bytes of a chart .tgz holding <name>/Chart.yaml and files
+    :arg name chart name, also the top folder of the archive
+    :arg version chart version
+    :arg files dict of member path below the chart folder to bytes
+    :arg chart_yaml Chart.yaml content, generated from name and version
+         when None
+    """
+    if chart_yaml is None:
+        chart_yaml = f"apiVersion: v2\nname: {name}\nversion: {version}\n"
+    members = {"Chart.yaml": chart_yaml.encode()}
+    members.update(files or {})
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for path, content in members.items():
+            info = tarfile.TarInfo(f"{name}/{path}" if name else path)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def write_file(path, content):
+    """
+    Write bytes or text to path, creating its folder
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mode = "wb" if isinstance(content, bytes) else "w"
+    with open(path, mode) as out_file:
+        out_file.write(content)
+    return path
+
+
+def fake_helm(testcase, handler=None):
+    """
+    Patch helm_common.execute_helm_command for the duration of testcase
+    and return the list the executed command lines are recorded in
+    :arg testcase unittest.TestCase, the patch is undone on cleanup
+    :arg handler callable(cmd, cwd) returning a HelmCommandResult or None
+             for a successful call without output
+    """
+    # pylint: disable=import-outside-toplevel
+    from unittest import mock
+
+    import helm_common
+
+    commands = []
+
+    def execute(cmd, cwd=None, **_kwargs):
+        commands.append(cmd)
+        result = handler(cmd, cwd) if handler else None
+        return result or helm_common.HelmCommandResult(0, "", "")
+
+    patcher = mock.patch.object(helm_common, "execute_helm_command",
+                                execute)
+    patcher.start()
+    testcase.addCleanup(patcher.stop)
+    return commands
+
+
+class RepoHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves server.files, honours Range requests and records every request
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serve a file, a redirect or a range of a file
+        """
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path in self.server.redirects:
+            self._reply(302, b"",
+                        {"Location": self.server.redirects[self.path]})
+            return
+        body = self.server.files.get(self.path)
+        if body is None:
+            self._reply(404, b"")
+            return
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            if start >= len(body):
+                self._reply(416, b"")
+                return
+            self._reply(206, body[start:], {
+                "Content-Range": f"bytes {start}-{len(body) - 1}/{len(body)}"})
+            return
+        self._reply(200, body)
+
+    def _reply(self, status, body, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def start_repo_server(testcase):
+    """
+    Start a local chart repository served by RepoHandler, stopped on
+    testcase cleanup
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RepoHandler)
+    server.files = {}
+    server.redirects = {}
+    server.requests = []
+    server.connections = 0
+    server.ranges = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    testcase.addCleanup(server.server_close)
+    testcase.addCleanup(server.shutdown)
+    return server
+
+
+def server_url(server):
+    """
+    Base url of a server started by start_repo_server
+    """
+    return f"http://127.0.0.1:{server.server_address[1]}"
@@ -0,0 +1,156 @@
+"""
+Selective extraction of chart archive members
+"""
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+from helm_test_utils import chart_archive
+from helm_test_utils import fake_helm
+from helm_test_utils import write_file
+
+# pylint: disable=wrong-import-order
+from helm_common import Helm
+from helm_common import HelmCommonException
+from helm_common import extract_chart_members
+
+
+class TestExtractChartMembers(unittest.TestCase):
+    """
+    Pattern matching, subchart recursion and unsafe paths
+    """
+
+    def setUp(self):
+        subchart = chart_archive("sub", "0.1.0", {
+            "templates/s.yaml": b"s",
+            "values.yaml": b"sub: true"})
+        self.archive = io.BytesIO(chart_archive("demo", "1.0.0", {
+            "values.yaml": b"a: 1",
+            "templates/a.yaml": b"a",
+            "templates/sub/b.yaml": b"b",
+            "charts/sub-0.1.0.tgz": subchart}))
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.destination = tmp_dir.name
+
+    def _extract(self, patterns, **kwargs):
+        self.archive.seek(0)
+        return extract_chart_members(self.archive, patterns, **kwargs)
+
+    def test_wildcard_stays_in_segment(self):
+        self.assertEqual(list(self._extract("templates/*.yaml")),
+                         ["demo/templates/a.yaml"])
+
+    def test_double_star_spans_segments(self):
+        self.assertEqual(sorted(self._extract("templates/**/*.yaml")),
+                         ["demo/templates/a.yaml",
+                          "demo/templates/sub/b.yaml"])
+        self.assertEqual(len(self._extract("**")), 5)
+
+    def test_pattern_list(self):
+        self.assertEqual(
+            self._extract(["Chart.yaml", "values.yaml"]),
+            {"demo/Chart.yaml": b"apiVersion: v2\nname: demo\n"
+                                b"version: 1.0.0\n",
+             "demo/values.yaml": b"a: 1"})
+
+    def test_subcharts_are_matched_with_their_prefix(self):
+        self.assertEqual(self._extract("charts/*/values.yaml"), {})
+        self.assertEqual(
+            self._extract(["values.yaml", "charts/*/values.yaml"],
+                          recurse_subcharts=True),
+            {"demo/values.yaml": b"a: 1",
+             "demo/charts/sub/values.yaml": b"sub: true"})
+        self.assertEqual(
+            list(self._extract("charts/sub/templates/*.yaml",
+                               recurse_subcharts=True)),
+            ["demo/charts/sub/templates/s.yaml"])
+
+    def test_extract_to_destination_returns_paths(self):
+        self.archive.seek(0)
+        extracted = extract_chart_members(self.archive, "templates/*.yaml",
+                                          self.destination)
+        target = os.path.join(self.destination, "demo", "templates",
+                              "a.yaml")
+        self.assertEqual(extracted, [target])
+        with open(target, "rb") as extracted_file:
+            self.assertEqual(extracted_file.read(), b"a")
+
+    def test_archive_path(self):
+        path = write_file(os.path.join(self.destination, "demo.tgz"),
+                          self.archive.getvalue())
+        self.assertEqual(list(extract_chart_members(path, "Chart.yaml")),
+                         ["demo/Chart.yaml"])
+
+    def test_parent_path_is_rejected(self):
+        archive = io.BytesIO(chart_archive(
+            "demo", "1.0.0", {"../../escape.yaml": b"x"}))
+        with self.assertRaises(HelmCommonException):
+            extract_chart_members(archive, "**", self.destination)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.destination, os.pardir, "escape.yaml")))
+
+    def test_absolute_path_is_rejected(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            info = tarfile.TarInfo("/etc/escape.yaml")
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b"x"))
+        buffer.seek(0)
+        with self.assertRaises(HelmCommonException):
+            extract_chart_members(buffer, "**")
+
+
+class TestFetchUntarMembers(unittest.TestCase):
+    """
+    Helm.fetch_untar with members
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        environ = mock.patch.dict(os.environ, {"HOME": self.root})
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop("HELM_HOME", None)
+        fake_helm(self)
+        self.helm = Helm()
+        self.workspace = os.path.join(self.root, "workspace")
+
+    def _fetch_untar(self, content, **kwargs):
+        def fetch(_chart_name, _version, _repo, workspace, **_kwargs):
+            return write_file(os.path.join(workspace, "demo-1.0.0.tgz"),
+                              content)
+
+        with mock.patch.object(self.helm, "fetch", side_effect=fetch):
+            return self.helm.fetch_untar("demo", "1.0.0", "https://repo",
+                                         workspace=self.workspace,
+                                         members="values.yaml", **kwargs)
+
+    def test_in_memory_does_not_create_workspace(self):
+        archive = chart_archive("demo", "1.0.0", {"values.yaml": b"a: 1"})
+        self.assertEqual(self._fetch_untar(archive, in_memory=True),
+                         {"demo/values.yaml": b"a: 1"})
+        self.assertFalse(os.path.exists(self.workspace))
+
+    def test_on_disk_returns_chart_name(self):
+        archive = chart_archive("demo", "1.0.0", {"values.yaml": b"a: 1"})
+        self.assertEqual(self._fetch_untar(archive), "demo")
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.workspace, "demo", "values.yaml")))
+
+    def test_unsafe_archive_returns_none(self):
+        archive = chart_archive("demo", "1.0.0", {"../../values.yaml": b"x"})
+        self.assertIsNone(self._fetch_untar(archive, in_memory=True))
+
+    def test_corrupt_archive_returns_none(self):
+        self.assertIsNone(self._fetch_untar(b"not a tarball",
+                                            in_memory=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+"""
+execute_helm_command and the helm output consumers
+"""
+import os
+import shlex
+import signal
+import sys
+import tempfile
+import unittest
+
+from helm_test_utils import write_file
+
+# pylint: disable=wrong-import-order
+from helm_common import HelmCommonException
+from helm_common import _SearchVersionParser
+from helm_common import execute_helm_command
+
+
+def _python(script, *args):
+    return " ".join(shlex.quote(arg)
+                    for arg in (sys.executable, "-c", script) + args)
+
+
+class TestExecuteHelmCommand(unittest.TestCase):
+    """
+    Output tail, return codes, masking, retries and consumers
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.log_file = os.path.join(self.root, "helm.log")
+
+    def _log(self):
+        with open(self.log_file, "r") as log:
+            return log.read()
+
+    def test_output_tail_is_bounded(self):
+        result = execute_helm_command(
+            _python("for i in range(20000): print(f'line {i:05d}')"),
+            tail_size=1000)
+        self.assertEqual(result.returncode, 0)
+        self.assertLessEqual(len(result.stdout), 1000)
+        self.assertTrue(result.stdout.endswith("line 19999\n"))
+
+    def test_long_line_is_read_in_chunks(self):
+        result = execute_helm_command(
+            _python("print('x' * 100000, end='')"), tail_size=1000)
+        self.assertEqual(result.stdout, "x" * 1000)
+
+    def test_timeout_returns_124(self):
+        result = execute_helm_command(
+            _python("import time; time.sleep(30)"), timeout=0.5)
+        self.assertEqual(result.returncode, 124)
+        self.assertIn("Killed after 0.5s timeout", result.stderr)
+
+    def test_signal_returns_128_plus_signal(self):
+        result = execute_helm_command(_python(
+            "import os, signal; os.kill(os.getpid(), signal.SIGTERM)"))
+        self.assertEqual(result.returncode, 128 + signal.SIGTERM)
+
+    def test_missing_binary_returns_127(self):
+        result = execute_helm_command(
+            os.path.join(self.root, "helm") + " version")
+        self.assertEqual(result.returncode, 127)
+        self.assertTrue(result.stderr)
+
+    def test_invalid_command_line(self):
+        result = execute_helm_command('helm repo add "unterminated')
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("Invalid command line", result.stderr)
+
+    def test_quoted_secret_is_masked(self):
+        secret = "p@ss word'"
+        result = execute_helm_command(
+            _python("import sys; print(sys.argv[1]); "
+                    "print(sys.argv[1], file=sys.stderr); sys.exit(3)",
+                    secret),
+            mask=secret, log_file=self.log_file)
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.stdout, "*****\n")
+        self.assertEqual(result.stderr, "*****\n")
+        log = self._log()
+        self.assertIn("*****", log)
+        self.assertNotIn("p@ss", log)
+
+    def test_retries_append_to_log_file(self):
+        counter = write_file(os.path.join(self.root, "counter"), "")
+        result = execute_helm_command(
+            _python("import sys\n"
+                    "with open(sys.argv[1], 'a+') as counter:\n"
+                    "    counter.write('x')\n"
+                    "    counter.seek(0)\n"
+                    "    attempt = len(counter.read())\n"
+                    "print(f'attempt {attempt}')\n"
+                    "sys.exit(0 if attempt == 3 else 1)",
+                    counter),
+            retries=5, log_file=self.log_file)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, "attempt 3\n")
+        self.assertEqual(result.log_file, self.log_file)
+        log = self._log()
+        self.assertEqual(log.count("$ "), 3)
+        for attempt in range(1, 4):
+            self.assertIn(f"attempt {attempt}\n", log)
+
+    def test_failing_consumer_does_not_block_the_command(self):
+        lines = []
+
+        def failing(_stream, _line):
+            raise ValueError("consumer failed")
+
+        with self.assertRaises(ValueError):
+            execute_helm_command(
+                _python("for i in range(100000): print(i)"),
+                consumers=[failing, lambda stream, line: lines.append(line)],
+                timeout=60)
+        # The command ran to its end, the other consumer got every line
+        self.assertEqual(len(lines), 100000)
+
+
+class TestSearchVersionParser(unittest.TestCase):
+    """
+    helm search --output yaml parsing, one list item at a time
+    """
+
+    OUTPUT = ("- app_version: 1.0.0\n"
+              "  description: demo\n"
+              "  name: repo/demo\n"
+              "  version: 1.0.0\n"
+              "- app_version: \"1.1\"\n"
+              "  name: repo/demo\n"
+              "  version: 1.1.0\n"
+              "- name: repo/demo\n"
+              "  version: 1.2.0\n")
+
+    def _parse(self, version, output=OUTPUT):
+        parser = _SearchVersionParser(version)
+        for line in output.splitlines(keepends=True):
+            parser("stdout", line)
+            parser("stderr", "- name: warning\n")
+        return parser.finish()
+
+    def test_matching_item(self):
+        self.assertEqual(self._parse("1.1.0"), {
+            "app_version": "1.1", "name": "repo/demo", "version": "1.1.0"})
+        self.assertEqual(self._parse("1.2.0")["version"], "1.2.0")
+
+    def test_stops_after_match(self):
+        parser = _SearchVersionParser("1.0.0")
+        for line in (self.OUTPUT + "- [invalid\n").splitlines(True):
+            parser("stdout", line)
+        self.assertEqual(parser.finish()["description"], "demo")
+
+    def test_no_match(self):
+        self.assertIsNone(self._parse("2.0.0"))
+        self.assertIsNone(self._parse("1.0.0", output="[]\n"))
+
+    def test_invalid_output(self):
+        with self.assertRaises(HelmCommonException):
+            self._parse("2.0.0", output="- name: [unclosed\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+HelmHttpTransport tests against local HTTP stand-in repositories
+"""
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+from helm_test_utils import chart_archive
+from helm_test_utils import server_url
+from helm_test_utils import start_repo_server
+
+# pylint: disable=wrong-import-order
+from helm_common import HelmCommonException
+from helm_common import HelmHttpTransport
+
+
+class TestHelmHttpTransport(unittest.TestCase):
+    """
+    Resume, digest, redirect and connection pool behaviour
+    """
+
+    def setUp(self):
+        self.archive = chart_archive("demo", "1.0.0")
+        self.repo = start_repo_server(self)
+        self.other = start_repo_server(self)
+        self.repo_url = server_url(self.repo)
+        self._publish(f"{self.repo_url}/demo-1.0.0.tgz")
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.destination = tmp_dir.name
+        environ = mock.patch.dict(os.environ, {"HOME": self.destination})
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop("NETRC", None)
+        self.transport = HelmHttpTransport()
+        self.addCleanup(self.transport.close)
+
+    def _publish(self, archive_url, digest=None):
+        index = {"apiVersion": "v1", "entries": {"demo": [{
+            "name": "demo", "version": "1.0.0",
+            "digest": digest or hashlib.sha256(self.archive).hexdigest(),
+            "urls": [archive_url]}]}}
+        self.repo.files["/index.yaml"] = yaml.safe_dump(index).encode()
+        self.repo.files["/demo-1.0.0.tgz"] = self.archive
+        self.other.files["/demo-1.0.0.tgz"] = self.archive
+
+    def _fetch(self, **kwargs):
+        return self.transport.fetch("demo", "1.0.0", self.repo_url,
+                                    self.destination, **kwargs)
+
+    def _read(self, path):
+        with open(path, "rb") as archive_file:
+            return archive_file.read()
+
+    def _write_part(self, data):
+        with open(os.path.join(self.destination, "demo-1.0.0.tgz.part"),
+                  "wb") as part_file:
+            part_file.write(data)
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            path = self._fetch()
+        self.assertEqual(self._read(path), self.archive)
+        self.assertEqual(self.repo.connections, 1)
+
+    def test_resume_with_range_request(self):
+        self._write_part(self.archive[:10])
+        path = self._fetch()
+        self.assertEqual(self._read(path), self.archive)
+        self.assertEqual(self.repo.requests[-1][1].get("Range"), "bytes=10-")
+
+    def test_resume_restarts_on_416(self):
+        self._write_part(self.archive + b"stale")
+        path = self._fetch()
+        self.assertEqual(self._read(path), self.archive)
+
+    def test_resume_restarts_without_range_support(self):
+        self.repo.ranges = False
+        self._write_part(b"garbage")
+        path = self._fetch()
+        self.assertEqual(self._read(path), self.archive)
+
+    def test_digest_mismatch(self):
+        self._publish(f"{self.repo_url}/demo-1.0.0.tgz", digest="0" * 64)
+        with self.assertRaises(HelmCommonException):
+            self._fetch()
+        self.assertEqual(os.listdir(self.destination), [])
+
+    def test_credentials_not_sent_to_other_archive_host(self):
+        self._publish(f"{server_url(self.other)}/demo-1.0.0.tgz")
+        self._fetch(helm_user="user", helm_token="secret")
+        self.assertIn("Authorization", self.repo.requests[-1][1])
+        self.assertNotIn("Authorization", self.other.requests[-1][1])
+
+    def test_credentials_sent_to_other_host_on_opt_in(self):
+        self._publish(f"{server_url(self.other)}/demo-1.0.0.tgz")
+        self._fetch(helm_user="user", helm_token="secret",
+                    pass_credentials=True)
+        self.assertIn("Authorization", self.other.requests[-1][1])
+
+    def test_credentials_stripped_on_redirect(self):
+        self.repo.redirects["/demo-1.0.0.tgz"] = (
+            f"{server_url(self.other)}/demo-1.0.0.tgz")
+        path = self._fetch(helm_user="user", helm_token="secret")
+        self.assertEqual(self._read(path), self.archive)
+        self.assertEqual(self.repo.requests[-1][0], "/demo-1.0.0.tgz")
+        self.assertIn("Authorization", self.repo.requests[-1][1])
+        self.assertNotIn("Authorization", self.other.requests[-1][1])
+
+    def test_invalid_index(self):
+        self.repo.files["/index.yaml"] = b"<html>not an index</html>"
+        with self.assertRaises(HelmCommonException):
+            self._fetch()
+
+
+if __name__ == "__main__":
+    unittest.main()
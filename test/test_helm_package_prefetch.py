@@ -0,0 +1,196 @@
+"""
+Dependency prefetch of Helm.package against a local HTTP repository
+"""
+import hashlib
+import os
+import shlex
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+from helm_test_utils import chart_archive
+from helm_test_utils import fake_helm
+from helm_test_utils import server_url
+from helm_test_utils import start_repo_server
+from helm_test_utils import write_file
+
+# pylint: disable=wrong-import-order
+from helm_common import Helm
+from helm_common import HelmChartContext
+from helm_common import HelmHttpTransport
+from helm_common import _DependencyPrefetch
+
+
+class _PrefetchTestCase(unittest.TestCase):
+    """
+    A chart depending on dep 1.0.0, served with 1.1.0 by a local repository
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        environ = mock.patch.dict(os.environ, {"HOME": self.root})
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop("NETRC", None)
+        os.environ.pop("HELM_HOME", None)
+        self.repo = start_repo_server(self)
+        self.repo_url = server_url(self.repo)
+        self.archives = {}
+        for version in ("1.0.0", "1.1.0"):
+            self.archives[version] = chart_archive("dep", version)
+        self.repo.files["/index.yaml"] = yaml.safe_dump({
+            "apiVersion": "v1", "entries": {"dep": [{
+                "name": "dep", "version": version,
+                "digest": hashlib.sha256(archive).hexdigest(),
+                "urls": [f"dep-{version}.tgz"]}
+                for version, archive in self.archives.items()]},
+        }).encode()
+        for version, archive in self.archives.items():
+            self.repo.files[f"/dep-{version}.tgz"] = archive
+        self.transport = HelmHttpTransport()
+        self.addCleanup(self.transport.close)
+
+    def _chart(self, version="1.0.0", repository=None, folder="chart"):
+        repository = repository or self.repo_url
+        chart_folder = os.path.join(self.root, folder)
+        write_file(os.path.join(chart_folder, "Chart.yaml"), (
+            "apiVersion: v2\nname: demo\nversion: 0.1.0\n"
+            "dependencies:\n"
+            f"- name: dep\n  version: {version}\n"
+            f"  repository: '{repository}'\n"))
+        write_file(os.path.join(chart_folder, "values.yaml"), "a: 1\n")
+        return chart_folder
+
+    def _prefetch(self, chart_folder, **kwargs):
+        dependencies = _DependencyPrefetch.prefetchable(
+            HelmChartContext.load(chart_folder))
+        return _DependencyPrefetch(lambda: self.transport, dependencies,
+                                   **kwargs)
+
+
+class TestDependencyPrefetch(_PrefetchTestCase):
+    """
+    prefetchable, fill and their fallback to helm dependency update
+    """
+
+    def test_prefetchable(self):
+        self.assertEqual(
+            [dependency["name"] for dependency in
+             _DependencyPrefetch.prefetchable(
+                 HelmChartContext.load(self._chart()))], ["dep"])
+        for version, repository in (("~1.0.0", None),
+                                    ("1.0.0", "file://../dep"),
+                                    ("1.0.0", "@stable")):
+            chart_folder = self._chart(version, repository,
+                                       folder=f"chart-{version}")
+            self.assertEqual(_DependencyPrefetch.prefetchable(
+                HelmChartContext.load(chart_folder)), [])
+
+    def test_fill_replaces_other_versions_only(self):
+        chart_folder = self._chart()
+        charts = os.path.join(chart_folder, "charts")
+        write_file(os.path.join(charts, "dep-0.9.0.tgz"), b"old")
+        write_file(os.path.join(charts, "dep-extra-1.0.0.tgz"), b"other")
+        with self._prefetch(chart_folder) as prefetch:
+            self.assertTrue(prefetch.fill(chart_folder))
+        self.assertEqual(sorted(os.listdir(charts)),
+                         ["dep-1.0.0.tgz", "dep-extra-1.0.0.tgz"])
+        with open(os.path.join(charts, "dep-1.0.0.tgz"), "rb") as archive:
+            self.assertEqual(archive.read(), self.archives["1.0.0"])
+
+    def test_fill_sends_credentials_to_the_repository(self):
+        chart_folder = self._chart()
+        with self._prefetch(chart_folder, helm_user="user",
+                            helm_token="secret") as prefetch:
+            self.assertTrue(prefetch.fill(chart_folder))
+        self.assertIn("Authorization", self.repo.requests[-1][1])
+
+    def test_fill_falls_back_when_dependencies_changed(self):
+        chart_folder = self._chart()
+        with self._prefetch(chart_folder) as prefetch:
+            Helm._replace_in_chart(  # pylint: disable=protected-access
+                ["Chart.yaml:1.0.0=1.1.0"], chart_folder)
+            self.assertFalse(prefetch.fill(chart_folder))
+        self.assertFalse(os.path.exists(os.path.join(chart_folder,
+                                                     "charts")))
+
+    def test_fill_falls_back_when_download_fails(self):
+        del self.repo.files["/dep-1.0.0.tgz"]
+        chart_folder = self._chart()
+        with self._prefetch(chart_folder) as prefetch:
+            self.assertFalse(prefetch.fill(chart_folder))
+
+    def test_fill_without_dependencies(self):
+        chart_folder = self._chart(version="~1.0.0")
+        with self._prefetch(chart_folder) as prefetch:
+            self.assertFalse(prefetch.fill(chart_folder))
+        self.assertEqual(self.repo.requests, [])
+
+
+class TestPackagePrefetch(_PrefetchTestCase):
+    """
+    Helm.package(prefetch_dependencies=True) with a fake helm binary
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.packaged = []
+        self.commands = fake_helm(self, self._helm)
+        self.helm = Helm()
+        self.helm._http_transport = self.transport
+        self.destination = os.path.join(self.root, "dist")
+
+    def _helm(self, cmd, _cwd):
+        args = shlex.split(cmd)
+        if args[1] != "package":
+            return None
+        chart_folder = args[-1]
+        destination = args[args.index("--destination") + 1]
+        version = args[args.index("--version") + 1]
+        charts = os.path.join(chart_folder, "charts")
+        self.packaged.append(sorted(os.listdir(charts))
+                             if os.path.isdir(charts) else [])
+        os.makedirs(destination, exist_ok=True)
+        with tarfile.open(os.path.join(destination, f"demo-{version}.tgz"),
+                          "w:gz") as tar:
+            tar.add(chart_folder, arcname="demo")
+        return None
+
+    def _package(self, **kwargs):
+        return self.helm.package(self._chart(), "0.2.0",
+                                 destination=self.destination,
+                                 workspace=self.root,
+                                 prefetch_dependencies=True, **kwargs)
+
+    def _package_command(self):
+        return [cmd for cmd in self.commands if " package " in cmd][-1]
+
+    def test_package_uses_prefetched_dependencies(self):
+        package = self._package()
+        self.assertEqual(package,
+                         os.path.join(self.destination, "demo-0.2.0.tgz"))
+        self.assertEqual(self.packaged, [["dep-1.0.0.tgz"]])
+        self.assertNotIn("--dependency-update", self._package_command())
+
+    def test_package_falls_back_after_replace(self):
+        self._package(replace=["Chart.yaml:1.0.0=1.1.0"])
+        self.assertEqual(self.packaged, [[]])
+        self.assertIn("--dependency-update", self._package_command())
+
+    def test_package_without_prefetch(self):
+        self.helm.package(self._chart(), "0.2.0",
+                          destination=self.destination,
+                          workspace=self.root)
+        self.assertEqual(self.packaged, [[]])
+        self.assertIn("--dependency-update", self._package_command())
+        self.assertFalse(any(path.endswith(".tgz")
+                             for path, _ in self.repo.requests))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Batch re-stamping of released chart archives
+"""
+import os
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+from helm_test_utils import chart_archive
+from helm_test_utils import fake_helm
+from helm_test_utils import write_file
+
+# pylint: disable=wrong-import-order
+from helm_common import Helm
+
+
+class TestReplaceInReleasedChartMany(unittest.TestCase):
+    """
+    Helm.replace_in_released_chart_many results and failures
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        environ = mock.patch.dict(os.environ, {"HOME": self.root})
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop("HELM_HOME", None)
+        fake_helm(self)
+        self.helm = Helm()
+
+    def _archive(self, folder, name="demo", version="1.0.0", **kwargs):
+        return write_file(
+            os.path.join(self.root, folder, f"{name}-{version}.tgz"),
+            chart_archive(name, version, {"values.yaml": b"image: 1.0\n"},
+                          **kwargs))
+
+    @staticmethod
+    def _values(package):
+        with tarfile.open(package, "r") as tar:
+            return tar.extractfile("demo/values.yaml").read()
+
+    def _files(self, folder):
+        return sorted(os.listdir(os.path.join(self.root, folder)))
+
+    def test_restamp_in_place(self):
+        archive = self._archive("released")
+        batch = self.helm.replace_in_released_chart_many(
+            ["1.0=2.0"], [archive, archive], workers=2)
+        self.assertEqual(batch.results, {archive: archive})
+        self.assertEqual(batch.failures, {})
+        self.assertEqual(self._values(archive), b"image: 2.0\n")
+        self.assertEqual(self._files("released"), ["demo-1.0.0.tgz"])
+        self.assertGreater(batch.bytes_in, 0)
+
+    def test_failures_are_reported_per_archive(self):
+        good = self._archive("released")
+        corrupt = write_file(os.path.join(self.root, "released",
+                                          "broken-1.0.0.tgz"), b"garbage")
+        unversioned = self._archive("released", name="other",
+                                    chart_yaml="name: other\n")
+        destination = os.path.join(self.root, "dist")
+        batch = self.helm.replace_in_released_chart_many(
+            ["1.0=2.0"], [good, corrupt, unversioned], destination)
+        self.assertEqual(batch.results,
+                         {good: os.path.join(destination, "demo-1.0.0.tgz")})
+        self.assertEqual(sorted(batch.failures), sorted([corrupt,
+                                                         unversioned]))
+        self.assertIn("chart version", batch.failures[unversioned])
+        self.assertEqual(self._files("dist"), ["demo-1.0.0.tgz"])
+
+    def test_same_output_is_reported_as_collision(self):
+        first = self._archive("first")
+        second = self._archive("second")
+        destination = os.path.join(self.root, "dist")
+        batch = self.helm.replace_in_released_chart_many(
+            ["1.0=2.0"], [first, second], destination)
+        package = os.path.join(destination, "demo-1.0.0.tgz")
+        self.assertEqual(batch.results, {first: package})
+        self.assertEqual(batch.failures, {
+            second: f"{package} is also the output of {first}"})
+        self.assertEqual(self._files("dist"), ["demo-1.0.0.tgz"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+HelmRepoIndex round trip tests
+"""
+import os
+import stat
+import tempfile
+import unittest
+
+import yaml
+
+from helm_test_utils import chart_archive
+from helm_test_utils import write_file
+
+# pylint: disable=wrong-import-order
+from helm_common import HelmCommonException
+from helm_common import HelmRepoIndex
+
+
+class TestHelmRepoIndex(unittest.TestCase):
+    """
+    Merge, ordering, sharding and compaction of index.yaml
+    """
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.index_path = os.path.join(self.root, "repo", "index.yaml")
+        self.shard_dir = os.path.join(self.root, "shards")
+        write_file(self.index_path, yaml.safe_dump({
+            "apiVersion": "v1",
+            "entries": {
+                "a": [{"name": "a", "version": version,
+                       "created": "2020-01-01T00:00:00.123456789Z",
+                       "urls": [f"a-{version}.tgz"]}
+                      for version in ("1.10.0", "1.2.0", "1.2.0-rc.1",
+                                      "1.0.0")],
+                "b": [{"name": "b", "version": "0.1.0",
+                       "urls": ["b-0.1.0.tgz"]}],
+            },
+        }))
+
+    def _archive(self, name, version, app_version=None):
+        chart_yaml = f"apiVersion: v2\nname: {name}\nversion: {version}\n"
+        if app_version:
+            chart_yaml += f"appVersion: \"{app_version}\"\n"
+        return write_file(
+            os.path.join(self.root, "charts", f"{name}-{version}.tgz"),
+            chart_archive(name, version, chart_yaml=chart_yaml))
+
+    def _versions(self):
+        with open(self.index_path, "r") as index_file:
+            entries = yaml.safe_load(index_file)["entries"]
+        return {name: [entry["version"] for entry in versions]
+                for name, versions in entries.items()}
+
+    def test_merge_keeps_existing_entries_in_semver_order(self):
+        index = HelmRepoIndex(self.index_path, base_url="https://repo/x/")
+        merged = index.add_archives([self._archive("a", "1.3.0"),
+                                     self._archive("c", "0.0.1")])
+        index.write()
+        self.assertEqual(merged, [("a", "1.3.0"), ("c", "0.0.1")])
+        self.assertEqual(self._versions(), {
+            "a": ["1.10.0", "1.3.0", "1.2.0", "1.2.0-rc.1", "1.0.0"],
+            "b": ["0.1.0"],
+            "c": ["0.0.1"]})
+        with open(self.index_path, "r") as index_file:
+            content = index_file.read()
+        self.assertIn("https://repo/x/c-0.0.1.tgz", content)
+        # Existing timestamps are kept verbatim
+        self.assertIn("2020-01-01T00:00:00.123456789Z", content)
+
+    def test_same_version_is_replaced(self):
+        index = HelmRepoIndex(self.index_path)
+        index.add_archives([self._archive("b", "0.1.0", app_version="1e3")])
+        index.write()
+        with open(self.index_path, "r") as index_file:
+            content = index_file.read()
+        entries = yaml.safe_load(content)["entries"]["b"]
+        self.assertEqual(len(entries), 1)
+        self.assertIn("digest", entries[0])
+        self.assertIn('appVersion: "1e3"', content)
+
+    def test_unseeded_shards_keep_index_entries(self):
+        index = HelmRepoIndex(self.index_path, shard_dir=self.shard_dir)
+        index.add_archives([self._archive("a", "2.0.0")])
+        index.write()
+        self.assertEqual(os.listdir(self.shard_dir), ["a.yaml"])
+        index.compact()
+        self.assertEqual(self._versions(), {
+            "a": ["2.0.0", "1.10.0", "1.2.0", "1.2.0-rc.1", "1.0.0"],
+            "b": ["0.1.0"]})
+
+    def test_shard_add_compact_round_trip(self):
+        HelmRepoIndex(self.index_path).shard(self.shard_dir)
+        self.assertEqual(sorted(os.listdir(self.shard_dir)),
+                         ["a.yaml", "b.yaml"])
+        index = HelmRepoIndex(self.index_path, shard_dir=self.shard_dir)
+        index.add_archives([self._archive("b", "0.2.0")])
+        index.write()
+        index.compact()
+        self.assertEqual(self._versions(), {
+            "a": ["1.10.0", "1.2.0", "1.2.0-rc.1", "1.0.0"],
+            "b": ["0.2.0", "0.1.0"]})
+
+    def test_shard_folder_next_to_index_is_refused(self):
+        with self.assertRaises(HelmCommonException):
+            HelmRepoIndex(self.index_path,
+                          shard_dir=os.path.dirname(self.index_path))
+
+    def test_write_keeps_index_mode(self):
+        os.chmod(self.index_path, 0o644)
+        index = HelmRepoIndex(self.index_path)
+        index.add_archives([self._archive("c", "0.0.1")])
+        index.write()
+        self.assertEqual(stat.S_IMODE(os.stat(self.index_path).st_mode),
+                         0o644)
+        self.assertEqual(os.listdir(os.path.dirname(self.index_path)),
+                         ["index.yaml"])
+
+
+if __name__ == "__main__":
+    unittest.main()